@@ -8,89 +8,313 @@ and provides recommendations for rate limiting
 import time
 import json
 import sys
-import urllib.request
+import http.client
 import urllib.parse
 import hmac
-import hashlib
 import base64
-from statistics import mean, median, stdev
+import math
+import queue
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from statistics import fmean, median
 from datetime import datetime
+from functools import lru_cache
+
+# orjson is optional; it only speeds up writing large reports
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps(obj):
+    """Serialize obj to indented JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode('utf-8')
+
+
+class RunningStats:
+    """One-pass mean and standard deviation (Welford's algorithm)"""
+    
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+    
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (x - self.mean)
+    
+    @property
+    def stdev(self):
+        return math.sqrt(self._m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+
+class BenchmarkResult:
+    """Outcome of a single benchmarked request"""
+    __slots__ = ("url", "method", "description", "status", "response_time",
+                 "success", "timestamp", "error", "locker_name")
+    
+    def __init__(self, url, method, description, status, response_time, success,
+                 timestamp, error=None, locker_name=None):
+        self.url = url
+        self.method = method
+        self.description = description
+        self.status = status
+        self.response_time = response_time
+        self.success = success
+        self.timestamp = timestamp
+        self.error = error
+        self.locker_name = locker_name
+    
+    def to_dict(self):
+        """Report representation; optional fields are omitted when unset"""
+        data = {key: getattr(self, key) for key in self.__slots__}
+        for key in ("error", "locker_name"):
+            if data[key] is None:
+                del data[key]
+        return data
+
 
 class GatewayBenchmark:
+    # Maximum number of cached locker_status request bodies
+    BODY_CACHE_SIZE = 32
+    # Upper bound on parallel connections in concurrent mode, to stay gentle
+    # on a single embedded gateway
+    MAX_CONCURRENCY = 5
+    
     def __init__(self, host, config_file="config.json"):
         self.host = host
         self.results = []
+        # Response times bucketed as results are recorded, so the report
+        # doesn't have to rescan self.results
+        self._ok_times = array('d')
+        self._ok_stats = RunningStats()
+        self._gateway_times = array('d')
+        self._locker_times = array('d')
+        self._failed_count = 0
+        # Per-endpoint throughput figures from the optional concurrent mode
+        self.concurrent_results = []
         self.config_file = config_file
         self.config = None
+        # Single keep-alive connection so each measurement is one round trip,
+        # not a TCP handshake plus a round trip
+        self.conn = http.client.HTTPConnection(host, timeout=10)
+        self._paths = {}
         
         # Try to load config for locker testing
         try:
-            with open(config_file, 'r') as f:
-                self.config = json.load(f)
-        except FileNotFoundError:
-            print(f"⚠️  Warning: {config_file} not found. Locker status tests will be skipped.")
+            self.config = self._load_config(config_file)
+            if self.config is None:
+                print(f"⚠️  Warning: {config_file} not found. Locker status tests will be skipped.")
         except json.JSONDecodeError as e:
             print(f"⚠️  Warning: {config_file} is invalid JSON: {e}. Locker status tests will be skipped.")
         
-    def benchmark_request(self, url, method="GET", data=None, description="", locker_name=None):
-        """Benchmark a single request and return timing info"""
+        # Keyed HMAC state per locker; copied for each request so the key
+        # schedule is only computed once per run
+        self._hmac_templates = {}
+        self._body_cache = {}
+        if self.config:
+            for locker_name, locker_config in self.config.get("lockers", {}).items():
+                code = locker_config.get("code")
+                if code:
+                    self._hmac_templates[locker_name] = hmac.new(code.encode("ascii"), None, "sha256")
+    
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _load_config(path):
+        """Load and cache a JSON config file, or return None if it doesn't exist"""
         try:
-            start_time = time.time()
-            
-            if method == "GET":
-                req = urllib.request.Request(url, method="GET")
-            else:  # POST
-                req = urllib.request.Request(url, data=data if data else b"", method="POST")
-            
-            with urllib.request.urlopen(req, timeout=10) as response:
-                response_data = response.read().decode('utf-8')
-                end_time = time.time()
-                
-                result = {
-                    "url": url,
-                    "method": method,
-                    "description": description,
-                    "status": response.status,
-                    "response_time": end_time - start_time,
-                    "success": True,
-                    "timestamp": datetime.now().isoformat()
-                }
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        """Close the persistent gateway connection"""
+        self.conn.close()
+    
+    def _path(self, url):
+        """Return the request path for a URL, cached per URL"""
+        path = self._paths.get(url)
+        if path is None:
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            self._paths[url] = path
+        return path
+    
+    def _record(self, result):
+        """Store a result and update the per-category buckets"""
+        self.results.append(result)
+        if not result.success:
+            self._failed_count += 1
+            return
+        self._ok_times.append(result.response_time)
+        self._ok_stats.add(result.response_time)
+        if result.locker_name is not None:
+            self._locker_times.append(result.response_time)
+        else:
+            self._gateway_times.append(result.response_time)
+        
+    def benchmark_request(self, url, method="GET", data=None, description="", locker_name=None):
+        """Benchmark a single request and return its BenchmarkResult
+        
+        If the gateway has already closed the reused keep-alive socket, the
+        request is resent once on a new connection instead of being recorded
+        as a failure.
+        """
+        path = self._path(url)
+        for attempt in range(2):
+            reused = self.conn.sock is not None
+            start_time = time.perf_counter()
+            try:
+                if method == "GET":
+                    self.conn.request("GET", path)
+                else:  # POST
+                    self.conn.request("POST", path, body=data if data else b"",
+                                      headers={"Content-Type": "application/x-www-form-urlencoded"})
                 
-                if locker_name:
-                    result["locker_name"] = locker_name
+                with self.conn.getresponse() as response:
+                    response.read()
+                    end_time = time.perf_counter()
+                    
+                    # http.client doesn't raise on error statuses; 4xx/5xx are failures
+                    success = response.status < 400
+                    result = BenchmarkResult(
+                        url=url,
+                        method=method,
+                        description=description,
+                        status=response.status,
+                        response_time=end_time - start_time,
+                        success=success,
+                        timestamp=datetime.now().isoformat(),
+                        error=None if success else f"HTTP Error {response.status}: {response.reason}",
+                        locker_name=locker_name or None
+                    )
+                    
+                    self._record(result)
+                    return result
+                    
+            except Exception as e:
+                end_time = time.perf_counter()
+                # Drop the connection so the next request starts from a clean socket
+                self.conn.close()
+                if (reused and attempt == 0 and isinstance(
+                        e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))):
+                    # Stale keep-alive socket; reconnect and send once more
+                    continue
+                result = BenchmarkResult(
+                    url=url,
+                    method=method,
+                    description=description,
+                    status=None,
+                    response_time=end_time - start_time,
+                    success=False,
+                    timestamp=datetime.now().isoformat(),
+                    error=str(e),
+                    locker_name=locker_name or None
+                )
                 
-                self.results.append(result)
+                self._record(result)
                 return result
-                
-        except Exception as e:
-            end_time = time.time()
-            result = {
-                "url": url,
-                "method": method,
-                "description": description,
-                "status": None,
-                "response_time": end_time - start_time,
-                "success": False,
-                "error": str(e),
-                "timestamp": datetime.now().isoformat()
-            }
-            
-            if locker_name:
-                result["locker_name"] = locker_name
-            
-            self.results.append(result)
-            return result
     
-    def _create_locker_status_request(self, identifier, code):
-        """Create authenticated locker status request data"""
+    def benchmark_concurrent(self, url, count, description=""):
+        """Send count GET requests in parallel and measure aggregate throughput
+        
+        At most MAX_CONCURRENCY requests are in flight at once; each worker
+        borrows a keep-alive connection from a pool of that size, so the
+        burst measures how the gateway handles a few parallel clients.
+        """
+        path = self._path(url)
+        workers = max(1, min(count, self.MAX_CONCURRENCY))
+        conns = queue.Queue()
+        for _ in range(workers):
+            conns.put(http.client.HTTPConnection(self.host, timeout=10))
+        
+        def timed_get(_):
+            conn = conns.get()
+            try:
+                start_time = time.perf_counter()
+                conn.request("GET", path)
+                with conn.getresponse() as response:
+                    response.read()
+                    status = response.status
+                elapsed = time.perf_counter() - start_time
+                # Error statuses count as failures, as in benchmark_request
+                return elapsed if status < 400 else None
+            except Exception:
+                conn.close()
+                return None
+            finally:
+                conns.put(conn)
+        
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(timed_get, range(count)))
+        wall_time = time.perf_counter() - wall_start
+        
+        while not conns.empty():
+            conns.get().close()
+        
+        times = [t for t in outcomes if t is not None]
+        result = {
+            "url": url,
+            "description": description,
+            "requests": count,
+            "concurrency": workers,
+            "successful": len(times),
+            "failed": count - len(times),
+            "wall_time": wall_time,
+            "avg_response_time": fmean(times) if times else None,
+            "throughput": len(times) / wall_time if wall_time > 0 else None,
+            "timestamp": datetime.now().isoformat()
+        }
+        self.concurrent_results.append(result)
+        return result
+    
+    def _create_locker_status_request(self, locker_name, identifier):
+        """Create authenticated locker status request data
+        
+        The body only depends on the locker and the one-second timestamp, so
+        requests made within the same second reuse the cached body.
+        """
         ts = str(int(time.time()))
-        hm = hmac.new(code.encode("ascii"), ts.encode("ascii"), hashlib.sha256)
+        key = (locker_name, ts)
+        data = self._body_cache.get(key)
+        if data is not None:
+            return data
+        
+        hm = self._hmac_templates[locker_name].copy()
+        hm.update(ts.encode("ascii"))
         hash_value = base64.b64encode(hm.digest()).decode('ascii')
         data = urllib.parse.urlencode({"hash": hash_value, "identifier": identifier, "ts": ts}).encode("ascii")
+        
+        # Simple FIFO eviction keeps the cache bounded
+        if len(self._body_cache) >= self.BODY_CACHE_SIZE:
+            del self._body_cache[next(iter(self._body_cache))]
+        self._body_cache[key] = data
         return data
     
-    def run_benchmark_suite(self, iterations=5):
-        """Run a comprehensive benchmark suite"""
+    def run_benchmark_suite(self, iterations=5, inter_request_delay=0.0, concurrent=False):
+        """Run a comprehensive benchmark suite
+        
+        Args:
+            iterations: Number of requests per endpoint
+            inter_request_delay: Optional pause (seconds) between iterations
+            concurrent: Also send each gateway endpoint's iterations in parallel
+                        to measure throughput (locker endpoints stay serial)
+        """
         print(f"""
 ╔══════════════════════════════════════════════════════════════╗
 ║         The Keys Gateway Benchmark Tool                      ║
@@ -111,34 +335,54 @@ class GatewayBenchmark:
         print("=" * 70)
         
         for test in tests:
-            print(f"\n📊 Testing: {test['desc']} ({test['method']} {test['url']})")
+            url, method, desc = test['url'], test['method'], test['desc']
+            print(f"\n📊 Testing: {desc} ({method} {url})", flush=True)
             times = []
+            stats = RunningStats()
+            # Per-request lines are buffered and written once the block finishes,
+            # so terminal writes don't land between timed requests
+            lines = []
             
             for i in range(iterations):
-                result = self.benchmark_request(
-                    test['url'], 
-                    test['method'],
-                    description=test['desc']
-                )
+                result = self.benchmark_request(url, method, description=desc)
                 
-                if result['success']:
-                    times.append(result['response_time'])
-                    print(f"  ✅ Request {i+1}/{iterations}: {result['response_time']:.3f}s (HTTP {result['status']})")
+                if result.success:
+                    times.append(result.response_time)
+                    stats.add(result.response_time)
+                    lines.append(f"  ✅ Request {i+1}/{iterations}: {result.response_time:.3f}s (HTTP {result.status})")
                 else:
-                    print(f"  ❌ Request {i+1}/{iterations}: FAILED - {result.get('error', 'Unknown error')}")
+                    lines.append(f"  ❌ Request {i+1}/{iterations}: FAILED - {result.error or 'Unknown error'}")
                 
-                # Small delay between requests to avoid overwhelming the server
-                if i < iterations - 1:
-                    time.sleep(0.5)
+                # Optional pacing between requests to avoid overwhelming the server
+                if inter_request_delay and i < iterations - 1:
+                    time.sleep(inter_request_delay)
+            
+            if lines:
+                print("\n".join(lines))
             
             if times:
                 print(f"\n  📈 Statistics:")
-                print(f"     Mean:   {mean(times):.3f}s")
+                print(f"     Mean:   {stats.mean:.3f}s")
                 print(f"     Median: {median(times):.3f}s")
                 print(f"     Min:    {min(times):.3f}s")
                 print(f"     Max:    {max(times):.3f}s")
                 if len(times) > 1:
-                    print(f"     StdDev: {stdev(times):.3f}s")
+                    print(f"     StdDev: {stats.stdev:.3f}s")
+        
+        if concurrent and iterations > 0:
+            workers = min(iterations, self.MAX_CONCURRENCY)
+            print(f"\n\n⚡ Concurrent Throughput Tests ({iterations} requests, {workers} in parallel)")
+            print("=" * 70)
+            
+            for test in tests:
+                result = self.benchmark_concurrent(test['url'], iterations, description=test['desc'])
+                print(f"\n📊 Testing: {test['desc']} ({test['method']} {test['url']})")
+                if result['successful']:
+                    print(f"  ✅ {result['successful']}/{iterations} succeeded in {result['wall_time']:.3f}s")
+                    print(f"     Avg latency: {result['avg_response_time']:.3f}s")
+                    print(f"     Throughput:  {result['throughput']:.2f} requests/second")
+                else:
+                    print(f"  ❌ All {iterations} concurrent requests FAILED")
         
         # Test individual locker status endpoints if config is available
         if self.config and "lockers" in self.config:
@@ -148,6 +392,7 @@ class GatewayBenchmark:
                 print(f"\n\n🔐 Testing Locker Status Commands")
                 print("=" * 70)
                 print("(Simulating: ./lock.py LOCKER_ID status)")
+                locker_status_url = f"{base_url}/locker_status"
                 
                 for locker_name, locker_config in lockers.items():
                     identifier = locker_config.get("identifier")
@@ -158,39 +403,46 @@ class GatewayBenchmark:
                         print(f"\n⏭️  Skipping {locker_name}: Not configured (placeholder values)")
                         continue
                     
-                    print(f"\n📊 Testing: Locker {locker_name} Status (POST /locker_status)")
+                    print(f"\n📊 Testing: Locker {locker_name} Status (POST /locker_status)", flush=True)
                     times = []
+                    stats = RunningStats()
+                    lines = []
+                    desc = f"Locker {locker_name} Status"
                     
                     for i in range(iterations):
                         # Create authenticated request
-                        data = self._create_locker_status_request(identifier, code)
+                        data = self._create_locker_status_request(locker_name, identifier)
                         
                         result = self.benchmark_request(
-                            f"{base_url}/locker_status",
+                            locker_status_url,
                             "POST",
                             data=data,
-                            description=f"Locker {locker_name} Status",
+                            description=desc,
                             locker_name=locker_name
                         )
                         
-                        if result['success']:
-                            times.append(result['response_time'])
-                            print(f"  ✅ Request {i+1}/{iterations}: {result['response_time']:.3f}s (HTTP {result['status']})")
+                        if result.success:
+                            times.append(result.response_time)
+                            stats.add(result.response_time)
+                            lines.append(f"  ✅ Request {i+1}/{iterations}: {result.response_time:.3f}s (HTTP {result.status})")
                         else:
-                            print(f"  ❌ Request {i+1}/{iterations}: FAILED - {result.get('error', 'Unknown error')}")
+                            lines.append(f"  ❌ Request {i+1}/{iterations}: FAILED - {result.error or 'Unknown error'}")
                         
-                        # Delay between requests
-                        if i < iterations - 1:
-                            time.sleep(0.5)
+                        # Optional pacing between requests
+                        if inter_request_delay and i < iterations - 1:
+                            time.sleep(inter_request_delay)
+                    
+                    if lines:
+                        print("\n".join(lines))
                     
                     if times:
                         print(f"\n  📈 Statistics for {locker_name}:")
-                        print(f"     Mean:   {mean(times):.3f}s")
+                        print(f"     Mean:   {stats.mean:.3f}s")
                         print(f"     Median: {median(times):.3f}s")
                         print(f"     Min:    {min(times):.3f}s")
                         print(f"     Max:    {max(times):.3f}s")
                         if len(times) > 1:
-                            print(f"     StdDev: {stdev(times):.3f}s")
+                            print(f"     StdDev: {stats.stdev:.3f}s")
             else:
                 print(f"\n⚠️  No lockers configured in {self.config_file}")
         else:
@@ -206,45 +458,39 @@ class GatewayBenchmark:
             print("❌ No benchmark data available")
             return
         
-        successful_results = [r for r in self.results if r['success']]
-        failed_results = [r for r in self.results if not r['success']]
-        
-        # Separate results by type
-        gateway_results = [r for r in successful_results if 'locker_name' not in r]
-        locker_results = [r for r in successful_results if 'locker_name' in r]
+        response_times = self._ok_times
+        gateway_times = self._gateway_times
+        locker_times = self._locker_times
+        failed_count = self._failed_count
+        avg_time = self._ok_stats.mean if response_times else None
         
         print(f"\n📈 Overall Statistics:")
         print(f"   Total Requests:      {len(self.results)}")
-        print(f"   Successful:          {len(successful_results)}")
-        print(f"   Failed:              {len(failed_results)}")
-        print(f"   Gateway Tests:       {len(gateway_results)}")
-        print(f"   Locker Status Tests: {len(locker_results)}")
+        print(f"   Successful:          {len(response_times)}")
+        print(f"   Failed:              {failed_count}")
+        print(f"   Gateway Tests:       {len(gateway_times)}")
+        print(f"   Locker Status Tests: {len(locker_times)}")
         
-        if successful_results:
-            response_times = [r['response_time'] for r in successful_results]
+        if response_times:
             print(f"\n⏱️  Response Time Statistics (All Endpoints):")
-            print(f"   Average:    {mean(response_times):.3f}s")
+            print(f"   Average:    {avg_time:.3f}s")
             print(f"   Median:     {median(response_times):.3f}s")
             print(f"   Fastest:    {min(response_times):.3f}s")
             print(f"   Slowest:    {max(response_times):.3f}s")
             if len(response_times) > 1:
-                print(f"   Std Dev:    {stdev(response_times):.3f}s")
+                print(f"   Std Dev:    {self._ok_stats.stdev:.3f}s")
             
             # Break down by endpoint type
-            if gateway_results and locker_results:
-                gateway_times = [r['response_time'] for r in gateway_results]
-                locker_times = [r['response_time'] for r in locker_results]
-                
+            if gateway_times and locker_times:
                 print(f"\n⏱️  Gateway Endpoints (status, list):")
-                print(f"   Average:    {mean(gateway_times):.3f}s")
+                print(f"   Average:    {fmean(gateway_times):.3f}s")
                 print(f"   Median:     {median(gateway_times):.3f}s")
                 
                 print(f"\n⏱️  Locker Status Endpoints (./lock.py LOCKER_ID status):")
-                print(f"   Average:    {mean(locker_times):.3f}s")
+                print(f"   Average:    {fmean(locker_times):.3f}s")
                 print(f"   Median:     {median(locker_times):.3f}s")
             
             # Rate limiting recommendations
-            avg_time = mean(response_times)
             print(f"\n💡 Rate Limiting Recommendations:")
             print(f"   Based on average response time of {avg_time:.3f}s:")
             
@@ -255,8 +501,8 @@ class GatewayBenchmark:
             print(f"   • Recommended for bulk operations: {recommended_delay:.2f}s delay")
             
             # For light operations (status queries)
-            if gateway_results:
-                gateway_avg = mean([r['response_time'] for r in gateway_results])
+            if gateway_times:
+                gateway_avg = fmean(gateway_times)
                 light_delay = max(gateway_avg * 0.5, 0.2)
                 print(f"   • For light operations (status/list): {light_delay:.2f}s delay")
             
@@ -266,20 +512,32 @@ class GatewayBenchmark:
             max_workers = min(int(1 / discovery_delay), 5)
             print(f"   • Recommended max workers for discovery: {max_workers}")
         
+        # Serial vs concurrent throughput, side by side
+        measured = [r for r in self.concurrent_results if r['successful']]
+        if measured:
+            print(f"\n⚡ Throughput (serial vs concurrent):")
+            for r in measured:
+                serial_times = [res.response_time for res in self.results
+                                if res.success and res.url == r['url']]
+                serial = f"{1 / fmean(serial_times):.2f} req/s" if serial_times else "n/a"
+                print(f"   {r['description']:20s} serial: {serial:>12s}   "
+                      f"concurrent (x{r['concurrency']}): {r['throughput']:.2f} req/s")
+        
         # Save detailed results to file
         report_file = f"benchmark_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(report_file, 'w') as f:
-            json.dump({
+        with open(report_file, 'wb') as f:
+            f.write(_dumps({
                 "host": self.host,
                 "timestamp": datetime.now().isoformat(),
-                "results": self.results,
+                "results": [r.to_dict() for r in self.results],
+                "concurrent": self.concurrent_results,
                 "summary": {
                     "total_requests": len(self.results),
-                    "successful": len(successful_results),
-                    "failed": len(failed_results),
-                    "avg_response_time": mean([r['response_time'] for r in successful_results]) if successful_results else None
+                    "successful": len(response_times),
+                    "failed": failed_count,
+                    "avg_response_time": avg_time
                 }
-            }, f, indent=2)
+            }))
         
         print(f"\n💾 Detailed report saved to: {report_file}")
         print("\n✅ Benchmark complete!\n")
@@ -288,14 +546,16 @@ class GatewayBenchmark:
 def main():
     # Try to load gateway from config.json
     try:
-        with open("config.json", "r") as f:
-            config = json.load(f)
-            default_host = config.get("gateway", "192.168.0.129")
-    except:
-        default_host = "192.168.0.129"
+        config = GatewayBenchmark._load_config("config.json") or {}
+    except (OSError, json.JSONDecodeError):
+        config = {}
+    default_host = config.get("gateway", "192.168.0.129")
+    
+    concurrent = "--concurrent" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--concurrent"]
     
-    if len(sys.argv) > 1:
-        host = sys.argv[1]
+    if len(args) > 0:
+        host = args[0]
     else:
         host = default_host
         print(f"No host specified, using from config.json: {host}")
@@ -304,15 +564,22 @@ def main():
     host = host.replace("http://", "").replace("https://", "")
     
     iterations = 5
-    if len(sys.argv) > 2:
+    if len(args) > 1:
         try:
-            iterations = int(sys.argv[2])
+            iterations = int(args[1])
         except:
             print(f"Invalid iterations count, using default: {iterations}")
     
-    benchmark = GatewayBenchmark(host)
-    benchmark.run_benchmark_suite(iterations)
-    benchmark.generate_report()
+    delay = 0.0
+    if len(args) > 2:
+        try:
+            delay = float(args[2])
+        except:
+            print(f"Invalid delay, using default: {delay}")
+    
+    with GatewayBenchmark(host) as benchmark:
+        benchmark.run_benchmark_suite(iterations, inter_request_delay=delay, concurrent=concurrent)
+        benchmark.generate_report()
 
 
 if __name__ == "__main__":